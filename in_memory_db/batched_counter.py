@@ -0,0 +1,58 @@
+import os
+import threading
+import time
+
+class BatchedCounter:
+    """Counts into thread-locals and flushes to a prometheus Counter in bulk,
+    keeping the Counter's internal lock off the request path"""
+
+    def __init__(self, counter, interval=0.1):
+        self._counter = counter
+        self._interval = interval
+        self._reset()
+        # A forked child has no flusher thread and must not re-flush the
+        # parent's counts, whatever the parent did before forking
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._tls = threading.local()
+        # One [thread, counted, flushed] cell per thread; only the owning
+        # thread writes counted and only the flusher writes flushed
+        self._cells = []
+        self._cells_lock = threading.Lock()
+        self._flusher = None
+
+    def inc(self):
+        try:
+            self._tls.cell[1] += 1
+        except AttributeError:
+            self._tls.cell = [threading.current_thread(), 1, 0]
+            with self._cells_lock:
+                self._cells.append(self._tls.cell)
+                if self._flusher is None:
+                    # Started lazily, on first use in each process
+                    self._flusher = threading.Thread(target=self._run, daemon=True)
+                    self._flusher.start()
+
+    def flush(self):
+        with self._cells_lock:
+            cells = list(self._cells)
+        finished = set()
+        for cell in cells:
+            # Check liveness first so a dead thread's last counts are read
+            alive = cell[0].is_alive()
+            counted = cell[1]
+            if counted != cell[2]:
+                self._counter.inc(counted - cell[2])
+                cell[2] = counted
+            if not alive:
+                finished.add(id(cell))
+        if finished:
+            with self._cells_lock:
+                self._cells = [c for c in self._cells if id(c) not in finished]
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            self.flush()
@@ -1,10 +1,19 @@
+import stat
+import sys
 import threading
+import time
+from contextlib import contextmanager
 import redis
 import psycopg2
+from psycopg2.errors import DeadlockDetected
+from psycopg2.extensions import connection as PGConnection
 from psycopg2.extras import DictCursor
+from psycopg2.pool import ThreadedConnectionPool
+from cachetools import TTLCache
 from loguru import logger
 from prometheus_client import Counter, Gauge, start_http_server
 from flask import Flask, jsonify
+from batched_counter import BatchedCounter
 import os
 
 app = Flask(__name__)
@@ -13,108 +22,325 @@ app = Flask(__name__)
 REQUEST_COUNT = Counter('db_request_total', 'Total number of requests')
 ACTIVE_TRANSACTIONS = Gauge('db_active_transactions', 'Number of active transactions')
 
+REQUEST_BATCH = BatchedCounter(REQUEST_COUNT)
+
+# Seconds a cached NUMEQUALTO result may live in Redis; bounds staleness if
+# an invalidation is missed
+COUNT_CACHE_TTL = 30
+# Seconds a cnt_ver:<value> version key outlives its last bump; only has to
+# exceed the time a NUMEQUALTO spends between reading it and filling the cache
+COUNT_VERSION_TTL = 24 * 3600
+# Fill cnt:<value> only if no SET bumped cnt_ver:<value> since the reader
+# looked it up, so a count read before a concurrent SET isn't cached
+FILL_COUNT_LUA = """
+if (redis.call('GET', KEYS[2]) or '') == ARGV[1] then
+    redis.call('SETEX', KEYS[1], ARGV[2], ARGV[3])
+end
+"""
+# Seconds a GET result may live in the process-local cache; bounds
+# staleness if an invalidation message is lost
+LOCAL_CACHE_TTL = 5
+# Attempts at kv_set before a SET that keeps losing deadlocks gives up
+SET_DEADLOCK_ATTEMPTS = 3
+# Pub/sub channel carrying names of keys whose cached GET result is stale
+INVALIDATION_CHANNEL = 'kv:invalidate'
+
+class PreparedConnection(PGConnection):
+    """Connection that remembers whether its statements are prepared"""
+    prepared = False
+
 class DistributedDB:
     def __init__(self):
-        # Redis for distributed locking
-        self.redis_client = redis.Redis(
+        # Redis: read-through cache for NUMEQUALTO counts and the channel
+        # for GET cache invalidations (replies stay bytes; hiredis handles
+        # RESP parsing in C when installed). The pool blocks when exhausted,
+        # because a failed call can mean a skipped invalidation; the pub/sub
+        # subscriber holds one of its connections for good.
+        self.redis_pool = redis.BlockingConnectionPool(
             host=os.getenv('REDIS_HOST', 'localhost'),
             port=int(os.getenv('REDIS_PORT', 6379)),
-            decode_responses=True
+            max_connections=int(os.getenv('REDIS_POOL_MAX', 32)),
+            timeout=float(os.getenv('REDIS_POOL_TIMEOUT', 5)),
+            decode_responses=False
         )
+        self.redis_client = redis.Redis(connection_pool=self.redis_pool)
+        self._fill_count = self.redis_client.register_script(FILL_COUNT_LUA)
         
-        # PostgreSQL connection
-        self.pg_conn = psycopg2.connect(
+        self._pg_params = dict(
             dbname=os.getenv('PG_DB', 'postgres'),
             user=os.getenv('PG_USER', 'postgres'),
             password=os.getenv('PG_PASSWORD', 'postgres'),
             host=os.getenv('PG_HOST', 'localhost'),
-            port=int(os.getenv('PG_PORT', 5432)
+            port=int(os.getenv('PG_PORT', 5432))
         )
         
-        # Initialize database tables
+        # Initialize database tables before any pooled connection exists
         self._init_db()
         
-        # Local thread lock
-        self._lock = threading.Lock()
+        # PostgreSQL connection pool, kept near (cores * 2) + 1: past that
+        # backends just queue for CPU, so callers wait for a free slot instead
+        max_conn = int(os.getenv('PG_POOL_MAX', (os.cpu_count() or 1) * 2 + 1))
+        self.pool = ThreadedConnectionPool(
+            minconn=min(4, max_conn),
+            maxconn=max_conn,
+            connection_factory=PreparedConnection,
+            **self._pg_params
+        )
+        # ThreadedConnectionPool raises when exhausted rather than blocking
+        self._pool_slots = threading.BoundedSemaphore(max_conn)
+
+        # Process-local LRU cache of GET results with a TTL, evicted on
+        # local SETs and on invalidations published by other instances
+        self._local_cache = TTLCache(
+            maxsize=int(os.getenv('LOCAL_CACHE_SIZE', 10000)),
+            ttl=LOCAL_CACHE_TTL
+        )
+        self._local_cache_lock = threading.RLock()
+        # Bumped on every eviction so a GET that raced a SET doesn't cache
+        # the value it read before the SET
+        self._local_cache_gen = 0
+        self._invalidation_thread = threading.Thread(
+            target=self._listen_for_invalidations, daemon=True
+        )
+        self._invalidation_thread.start()
+
+    def _evict(self, name):
+        with self._local_cache_lock:
+            self._local_cache.pop(name, None)
+            self._local_cache_gen += 1
+
+    def _clear_local_cache(self):
+        with self._local_cache_lock:
+            self._local_cache.clear()
+            self._local_cache_gen += 1
+
+    def _listen_for_invalidations(self):
+        """Evict keys named on INVALIDATION_CHANNEL; runs on a daemon thread"""
+        while True:
+            pubsub = self.redis_client.pubsub()
+            try:
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self._evict(message['data'].decode())
+                    elif message['type'] == 'subscribe':
+                        # (Re)subscribed, including redis-py's automatic
+                        # resubscribe after a reconnect: anything published
+                        # while we weren't listening is lost
+                        self._clear_local_cache()
+            except Exception as e:
+                logger.warning(f"Invalidation subscriber failed: {e}")
+            finally:
+                pubsub.close()
+            # Invalidations may be missed until we're subscribed again
+            self._clear_local_cache()
+            time.sleep(1)
+
+    @contextmanager
+    def _conn(self):
+        """Borrow a pooled connection with the hot-path statements prepared"""
+        with self._pool_slots:
+            conn = self.pool.getconn()
+            try:
+                if not conn.prepared:
+                    # Every hot-path call is a single statement, so let
+                    # each run as its own transaction
+                    conn.autocommit = True
+                    with conn.cursor() as cur:
+                        self._prepare_statements(cur)
+                    conn.prepared = True
+                yield conn
+            finally:
+                self.pool.putconn(conn)
         
     def _init_db(self):
-        with self.pg_conn.cursor() as cur:
-            # Create tables if they don't exist
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS key_value_store (
-                    name VARCHAR PRIMARY KEY,
-                    value VARCHAR
-                );
-                CREATE TABLE IF NOT EXISTS value_count (
-                    value VARCHAR PRIMARY KEY,
-                    count INTEGER DEFAULT 0
-                );
-                CREATE TABLE IF NOT EXISTS transactions (
-                    id SERIAL PRIMARY KEY,
-                    status VARCHAR
-                );
-            """)
-            self.pg_conn.commit()
-    
-    def _acquire_lock(self, key, timeout=10):
-        return self.redis_client.set(f'lock:{key}', 1, nx=True, ex=timeout)
-    
-    def _release_lock(self, key):
-        self.redis_client.delete(f'lock:{key}')
-    
-    def set(self, name, value):
-        REQUEST_COUNT.inc()
-        if not self._acquire_lock(name):
-            logger.error(f"Could not acquire lock for key: {name}")
-            return False
-            
+        # Schema setup runs on its own short-lived autocommit connection so
+        # pooled connections never carry DDL or its locks; every statement
+        # is idempotent, so there's nothing to group in a transaction
+        conn = psycopg2.connect(**self._pg_params)
+        conn.autocommit = True
         try:
-            with self.pg_conn.cursor() as cur:
-                # Get old value
-                cur.execute("SELECT value FROM key_value_store WHERE name = %s", (name,))
-                old_value = cur.fetchone()
-                
-                # Update value counts
-                if old_value:
-                    cur.execute("UPDATE value_count SET count = count - 1 WHERE value = %s", (old_value[0],))
+            with conn.cursor() as cur:
+                # Create tables if they don't exist
                 cur.execute("""
-                    INSERT INTO value_count (value, count) 
-                    VALUES (%s, 1) 
-                    ON CONFLICT (value) DO UPDATE SET count = value_count.count + 1
-                """, (value,))
-                
-                # Update key-value store
+                    CREATE TABLE IF NOT EXISTS key_value_store (
+                        name VARCHAR PRIMARY KEY,
+                        value VARCHAR
+                    );
+                    CREATE TABLE IF NOT EXISTS value_count (
+                        value VARCHAR PRIMARY KEY,
+                        count INTEGER DEFAULT 0
+                    );
+                    CREATE TABLE IF NOT EXISTS transactions (
+                        id SERIAL PRIMARY KEY,
+                        status VARCHAR
+                    );
+                """)
+                # Server-side SET: old-value lookup, count updates and the kv
+                # upsert run in one round trip, atomically, under a row lock on
+                # the key. Returns the previous value (NULL for a new key).
                 cur.execute("""
-                    INSERT INTO key_value_store (name, value) 
-                    VALUES (%s, %s) 
-                    ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value
-                """, (name, value))
-                
-                self.pg_conn.commit()
-                logger.info(f"Successfully set {name}={value}")
-                return True
+                    CREATE OR REPLACE FUNCTION kv_set(p_name VARCHAR, p_value VARCHAR)
+                    RETURNS VARCHAR AS $$
+                    DECLARE
+                        old_value VARCHAR;
+                    BEGIN
+                        -- Make sure the row exists so FOR UPDATE also serializes
+                        -- concurrent first writes of the same key
+                        INSERT INTO key_value_store (name, value)
+                        VALUES (p_name, NULL)
+                        ON CONFLICT (name) DO NOTHING;
+
+                        SELECT value INTO old_value
+                        FROM key_value_store
+                        WHERE name = p_name
+                        FOR UPDATE;
+
+                        -- Re-setting the current value changes nothing
+                        IF old_value = p_value THEN
+                            RETURN old_value;
+                        END IF;
+
+                        -- Lock the existing count rows in value order up
+                        -- front, so SETs swapping values (a->b on one key,
+                        -- b->a on another) don't lock them in opposite
+                        -- orders. A row another session creates after this
+                        -- point is locked out of order by the upsert below
+                        -- and can still deadlock; set() retries that case.
+                        PERFORM 1 FROM value_count
+                        WHERE value IN (old_value, p_value)
+                        ORDER BY value
+                        FOR UPDATE;
+
+                        IF old_value IS NOT NULL THEN
+                            UPDATE value_count SET count = count - 1 WHERE value = old_value;
+                        END IF;
+                        INSERT INTO value_count (value, count)
+                        VALUES (p_value, 1)
+                        ON CONFLICT (value) DO UPDATE SET count = value_count.count + 1;
+
+                        UPDATE key_value_store SET value = p_value WHERE name = p_name;
+                        RETURN old_value;
+                    END;
+                    $$ LANGUAGE plpgsql;
+                """)
         finally:
-            self._release_lock(name)
+            conn.close()
+
+    def _prepare_statements(self, cur):
+        # Parse/plan the hot-path queries once per connection; callers use
+        # EXECUTE. Prepared statements are session state, so this needs a
+        # session-mode pooler (not pgbouncer transaction mode).
+        cur.execute("""
+            PREPARE kv_get(VARCHAR) AS
+                SELECT value FROM key_value_store WHERE name = $1;
+            PREPARE kv_set_fn(VARCHAR, VARCHAR) AS
+                SELECT kv_set($1, $2);
+            PREPARE kv_count(VARCHAR) AS
+                SELECT count FROM value_count WHERE value = $1;
+        """)
+    
+    def set(self, name, value):
+        REQUEST_BATCH.inc()
+        for attempt in range(1, SET_DEADLOCK_ATTEMPTS + 1):
+            try:
+                with self._conn() as conn, conn.cursor() as cur:
+                    cur.execute("EXECUTE kv_set_fn(%s, %s)", (name, value))
+                    old_value = cur.fetchone()[0]
+                break
+            except DeadlockDetected as e:
+                # Postgres rolled the statement back; safe to run it again
+                if attempt == SET_DEADLOCK_ATTEMPTS:
+                    logger.error(f"Could not set {name}: {e}")
+                    return False
+                logger.warning(f"Deadlock setting {name}, retrying: {e}")
+            except psycopg2.Error as e:
+                logger.error(f"Could not set {name}: {e}")
+                return False
+
+        if old_value != value:
+            self._evict(name)
+            # Both the old and the new value's counts changed; drop them, bump
+            # their versions so in-flight NUMEQUALTO fills are discarded, and
+            # tell other instances to evict name, all in one round trip
+            changed = [value] if old_value is None else [value, old_value]
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.delete(*[f'cnt:{v}' for v in changed])
+            for v in changed:
+                pipe.incr(f'cnt_ver:{v}')
+                pipe.expire(f'cnt_ver:{v}', COUNT_VERSION_TTL)
+            pipe.publish(INVALIDATION_CHANNEL, name)
+            try:
+                pipe.execute()
+            except redis.RedisError as e:
+                logger.warning(f"Could not invalidate cached values for {name}: {e}")
+
+        logger.info(f"Successfully set {name}={value}")
+        return True
     
     def get(self, name):
-        REQUEST_COUNT.inc()
-        with self.pg_conn.cursor() as cur:
-            cur.execute("SELECT value FROM key_value_store WHERE name = %s", (name,))
+        REQUEST_BATCH.inc()
+        with self._local_cache_lock:
+            cached = self._local_cache.get(name)
+            gen = self._local_cache_gen
+        if cached is not None:
+            return cached
+
+        with self._conn() as conn, conn.cursor() as cur:
+            cur.execute("EXECUTE kv_get(%s)", (name,))
             result = cur.fetchone()
-            return result[0] if result else 'NULL'
+            value = result[0] if result else 'NULL'
+
+        with self._local_cache_lock:
+            if self._local_cache_gen == gen:
+                self._local_cache[name] = value
+        return value
     
     def numequalto(self, value):
-        REQUEST_COUNT.inc()
-        with self.pg_conn.cursor() as cur:
-            cur.execute("SELECT count FROM value_count WHERE value = %s", (value,))
+        REQUEST_BATCH.inc()
+        key = f'cnt:{value}'
+        version_key = f'cnt_ver:{value}'
+        version = None
+        try:
+            cached, version = self.redis_client.mget(key, version_key)
+            if cached is not None:
+                return int(cached)
+            version = version or b''
+        except redis.RedisError as e:
+            logger.warning(f"Count cache unavailable: {e}")
+
+        with self._conn() as conn, conn.cursor() as cur:
+            cur.execute("EXECUTE kv_count(%s)", (value,))
             result = cur.fetchone()
-            return result[0] if result else 0
+            count = result[0] if result else 0
+
+        if version is not None:
+            try:
+                self._fill_count(keys=[key, version_key],
+                                 args=[version, COUNT_CACHE_TTL, count])
+            except redis.RedisError as e:
+                logger.warning(f"Count cache unavailable: {e}")
+        return count
 
 # Health check endpoint
 @app.route('/health')
 def health_check():
     return jsonify({'status': 'healthy'})
 
+# Command name -> (argument count including the command, method, prints result)
+DISPATCH = {
+    'SET': (3, DistributedDB.set, False),
+    'GET': (2, DistributedDB.get, True),
+    'NUMEQUALTO': (2, DistributedDB.numequalto, True),
+}
+
+def _is_regular_file(stream):
+    """Whether stream reads from a regular file rather than a pipe or TTY"""
+    try:
+        return stat.S_ISREG(os.fstat(stream.fileno()).st_mode)
+    except (OSError, ValueError):
+        return False
+
 def main():
     # Start Prometheus metrics server
     start_http_server(8000)
@@ -123,30 +349,45 @@ def main():
     app.run(host='0.0.0.0', port=5000)
     
     db = DistributedDB()
+    # Flush before each blocking read unless commands come from a file (see
+    # simple_db.main)
+    write = sys.stdout.write
+    stdin = sys.stdin.buffer
+    interactive = not _is_regular_file(stdin)
     
     while True:
+        if interactive:
+            sys.stdout.flush()
+        line = stdin.readline()
+        if not line:
+            break
         try:
-            command = input().strip().split()
+            command = line.decode().split()
             if not command:
                 continue
 
-            cmd = command[0].upper()
+            cmd = command[0]
+            # Commands are normally upper case already; only fold when not
+            entry = DISPATCH.get(cmd) or DISPATCH.get(cmd.upper())
+            if entry is None:
+                if cmd.upper() == 'END':
+                    break
+                write('Invalid command\n')
+                continue
+
+            arity, method, prints = entry
+            if len(command) != arity:
+                write('Invalid command\n')
+                continue
+
+            result = method(db, *command[1:])
+            if prints and result is not None:
+                write(f'{result}\n')
 
-            if cmd == 'END':
-                break
-            elif cmd == 'SET' and len(command) == 3:
-                db.set(command[1], command[2])
-            elif cmd == 'GET' and len(command) == 2:
-                print(db.get(command[1]))
-            elif cmd == 'NUMEQUALTO' and len(command) == 2:
-                print(db.numequalto(command[2]))
-            else:
-                print('Invalid command')
-
-        except EOFError:
-            break
         except Exception as e:
             logger.error(f"Error processing command: {e}")
 
+    sys.stdout.flush()
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
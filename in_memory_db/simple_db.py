@@ -1,131 +1,243 @@
+import os
+import stat
+import sys
 import threading
+from collections import Counter
+
+# Number of lock stripes; must be a power of two
+LOCK_STRIPES = 64
+_STRIPE_MASK = LOCK_STRIPES - 1
+# Minimum counter table size before zero counters are pruned
+PRUNE_THRESHOLD = 1024
 
 class InMemoryDB:
+    # No per-instance __dict__; attribute loads on the hot path are slot reads
+    __slots__ = (
+        'db', 'value_count', '_prune_at',
+        'tx_log', 'tx_marks', 'tx_seen',
+        '_locks', '_count_lock', '_tx_lock',
+    )
+
     def __init__(self):
         # Main database storage
         self.db = {}
-        # Counter for values
-        self.value_count = {}
-        # Transaction stack
-        self.transactions = []
-        # Thread lock for synchronization
-        self._lock = threading.Lock()
+        # Counter for values; counters that drop to zero are left in place
+        # and pruned in bulk once the table outgrows _prune_at
+        self.value_count = Counter()
+        self._prune_at = PRUNE_THRESHOLD
+        # Transaction undo log: (name, old_value) entries for every open
+        # frame in one flat list, the log index each frame starts at, and
+        # the names each frame has already recorded
+        self.tx_log = []
+        self.tx_marks = []
+        self.tx_seen = []
+        # Keys are guarded by striped locks, _locks[hash(name) & _STRIPE_MASK].
+        # The value counters and the transaction lists each have one lock;
+        # those are never waited on before a key lock
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._count_lock = threading.Lock()
+        self._tx_lock = threading.Lock()
+
+    def _record_undo(self, name, old_value):
+        """Log old_value for rollback if name is new to the current frame"""
+        with self._tx_lock:
+            # Re-check: a COMMIT may have closed the frame meanwhile
+            if self.tx_marks:
+                seen = self.tx_seen[-1]
+                if name not in seen:
+                    seen.add(name)
+                    self.tx_log.append((name, old_value))
 
     def _update_value_count(self, old_value, new_value):
         """Helper method to update value counts"""
-        if old_value is not None:
-            self.value_count[old_value] = self.value_count.get(old_value, 0) - 1
-            if self.value_count[old_value] == 0:
-                del self.value_count[old_value]
-        
-        if new_value is not None:
-            self.value_count[new_value] = self.value_count.get(new_value, 0) + 1
+        with self._count_lock:
+            if old_value is not None:
+                self.value_count[old_value] -= 1
+            if new_value is not None:
+                self.value_count[new_value] += 1
+
+        if len(self.value_count) > self._prune_at:
+            self._prune_value_count()
+
+    def _prune_value_count(self):
+        """Drop counters that have fallen to zero"""
+        with self._count_lock:
+            if len(self.value_count) <= self._prune_at:
+                # Another writer pruned while we waited
+                return
+            for value in [v for v, n in self.value_count.items() if n <= 0]:
+                del self.value_count[value]
+            self._prune_at = max(PRUNE_THRESHOLD, 2 * len(self.value_count))
 
     def set(self, name, value):
         """Set the variable name to value"""
-        with self._lock:
+        with self._locks[hash(name) & _STRIPE_MASK]:
             old_value = self.db.get(name)
+            if old_value == value:
+                # No-op write; nothing to count or to undo, even in a
+                # transaction, since rollback would restore this same value
+                return
             
-            if self.transactions:
+            if self.tx_marks:
                 # If in a transaction, store the old value for potential rollback
-                current_transaction = self.transactions[-1]
-                if name not in current_transaction:
-                    current_transaction[name] = old_value
+                self._record_undo(name, old_value)
             
             self.db[name] = value
-            self._update_value_count(old_value, value)
+            # _update_value_count inlined: value is never None here
+            counts = self.value_count
+            with self._count_lock:
+                if old_value is not None:
+                    counts[old_value] -= 1
+                counts[value] += 1
+            if len(counts) > self._prune_at:
+                self._prune_value_count()
 
     def get(self, name):
         """Get the value of variable name"""
-        with self._lock:
-            return self.db.get(name, 'NULL')
+        # Lock-free: dict.get is a single CALL bytecode (see dis) and str keys
+        # hash/compare in C, so the lookup can't interleave with a writer and
+        # never sees a torn entry. Writers still hold the striped locks.
+        return self.db.get(name, 'NULL')
 
     def unset(self, name):
         """Unset the variable name"""
-        with self._lock:
+        with self._locks[hash(name) & _STRIPE_MASK]:
             if name in self.db:
                 old_value = self.db[name]
                 
-                if self.transactions:
+                if self.tx_marks:
                     # If in a transaction, store the old value for potential rollback
-                    current_transaction = self.transactions[-1]
-                    if name not in current_transaction:
-                        current_transaction[name] = old_value
+                    self._record_undo(name, old_value)
                 
                 del self.db[name]
-                self._update_value_count(old_value, None)
+                # _update_value_count inlined: only the decrement applies,
+                # and it can't grow the table, so no prune check either
+                with self._count_lock:
+                    self.value_count[old_value] -= 1
 
     def numequalto(self, value):
         """Return number of variables set to value"""
-        with self._lock:
-            return self.value_count.get(value, 0)
+        # Lock-free for the same reason as get
+        return self.value_count.get(value, 0)
 
     def begin(self):
         """Begin a new transaction block"""
-        with self._lock:
-            self.transactions.append({})
+        with self._tx_lock:
+            self.tx_marks.append(len(self.tx_log))
+            self.tx_seen.append(set())
 
     def rollback(self):
         """Rollback the most recent transaction"""
-        with self._lock:
-            if not self.transactions:
-                return 'NO TRANSACTION'
-
-            transaction = self.transactions.pop()
-            # Restore old values
-            for name, old_value in transaction.items():
-                current_value = self.db.get(name)
-                if old_value is None:
-                    if name in self.db:
-                        del self.db[name]
-                        self._update_value_count(current_value, None)
+        while True:
+            with self._tx_lock:
+                if not self.tx_marks:
+                    return 'NO TRANSACTION'
+                start = self.tx_marks[-1]
+                entries = self.tx_log[start:]
+                # Only the stripes of the keys this frame touched, in
+                # ascending order. Key locks rank before _tx_lock, so here
+                # they may only be tried, never waited on.
+                stripes = sorted({hash(name) & _STRIPE_MASK for name, _ in entries})
+                locks = [self._locks[i] for i in stripes]
+                held = []
+                for lock in locks:
+                    if not lock.acquire(blocking=False):
+                        break
+                    held.append(lock)
                 else:
-                    self.db[name] = old_value
-                    self._update_value_count(current_value, old_value)
+                    self.tx_marks.pop()
+                    self.tx_seen.pop()
+                    del self.tx_log[start:]
+
+            if len(held) == len(locks):
+                try:
+                    # Restore old values, newest first
+                    for name, old_value in reversed(entries):
+                        current_value = self.db.get(name)
+                        if old_value is None:
+                            if name in self.db:
+                                del self.db[name]
+                                self._update_value_count(current_value, None)
+                        else:
+                            self.db[name] = old_value
+                            self._update_value_count(current_value, old_value)
+                finally:
+                    for lock in reversed(held):
+                        lock.release()
+                return
+
+            # A writer holds one of the stripes: back off, wait for it
+            # without holding _tx_lock, then retry
+            for lock in reversed(held):
+                lock.release()
+            with locks[len(held)]:
+                pass
 
     def commit(self):
         """Commit all open transactions"""
-        with self._lock:
-            if not self.transactions:
+        with self._tx_lock:
+            if not self.tx_marks:
                 return 'NO TRANSACTION'
-            self.transactions.clear()
+            self.tx_log.clear()
+            self.tx_marks.clear()
+            self.tx_seen.clear()
+
+# Command name -> (argument count including the command, method, prints result)
+DISPATCH = {
+    'SET': (3, InMemoryDB.set, False),
+    'GET': (2, InMemoryDB.get, True),
+    'UNSET': (2, InMemoryDB.unset, False),
+    'NUMEQUALTO': (2, InMemoryDB.numequalto, True),
+    'BEGIN': (1, InMemoryDB.begin, False),
+    'ROLLBACK': (1, InMemoryDB.rollback, True),
+    'COMMIT': (1, InMemoryDB.commit, True),
+}
+
+def _is_regular_file(stream):
+    """Whether stream reads from a regular file rather than a pipe or TTY"""
+    try:
+        return stat.S_ISREG(os.fstat(stream.fileno()).st_mode)
+    except (OSError, ValueError):
+        return False
 
 def main():
     db = InMemoryDB()
+    # Replies are buffered, not flushed per line like print()/input(). When
+    # commands come from a pipe or TTY the sender may be waiting on a reply,
+    # so flush before each blocking read; file input flushes only at the end.
+    write = sys.stdout.write
+    stdin = sys.stdin.buffer
+    interactive = not _is_regular_file(stdin)
     
     while True:
-        try:
-            command = input().strip().split()
-            if not command:
-                continue
-
-            cmd = command[0].upper()
+        if interactive:
+            sys.stdout.flush()
+        line = stdin.readline()
+        if not line:
+            break
+        command = line.decode().split()
+        if not command:
+            continue
 
-            if cmd == 'END':
+        cmd = command[0]
+        # Commands are normally upper case already; only fold when not
+        entry = DISPATCH.get(cmd) or DISPATCH.get(cmd.upper())
+        if entry is None:
+            if cmd.upper() == 'END':
                 break
-            elif cmd == 'SET' and len(command) == 3:
-                db.set(command[1], command[2])
-            elif cmd == 'GET' and len(command) == 2:
-                print(db.get(command[1]))
-            elif cmd == 'UNSET' and len(command) == 2:
-                db.unset(command[1])
-            elif cmd == 'NUMEQUALTO' and len(command) == 2:
-                print(db.numequalto(command[2]))
-            elif cmd == 'BEGIN':
-                db.begin()
-            elif cmd == 'ROLLBACK':
-                result = db.rollback()
-                if result:
-                    print(result)
-            elif cmd == 'COMMIT':
-                result = db.commit()
-                if result:
-                    print(result)
-            else:
-                print('Invalid command')
-
-        except EOFError:
-            break
+            write('Invalid command\n')
+            continue
+
+        arity, method, prints = entry
+        if len(command) != arity:
+            write('Invalid command\n')
+            continue
+
+        result = method(db, *command[1:])
+        if prints and result is not None:
+            write(f'{result}\n')
+
+    sys.stdout.flush()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,84 @@
+import os
+import threading
+import unittest
+from batched_counter import BatchedCounter
+
+class StubCounter:
+    """Stands in for a prometheus Counter"""
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+    
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+class TestBatchedCounter(unittest.TestCase):
+    def setUp(self):
+        self.counter = StubCounter()
+        # Long interval so the tests decide when to flush
+        self.batch = BatchedCounter(self.counter, interval=60)
+    
+    def test_flush_totals(self):
+        self.batch.inc()
+        self.batch.inc()
+        self.assertEqual(self.counter.value, 0)
+        
+        self.batch.flush()
+        self.assertEqual(self.counter.value, 2)
+        
+        # Flushing again with nothing new adds nothing
+        self.batch.flush()
+        self.assertEqual(self.counter.value, 2)
+    
+    def test_concurrent_increments(self):
+        def worker():
+            for _ in range(10000):
+                self.batch.inc()
+        
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        # Flush while the workers are still counting
+        self.batch.flush()
+        for t in threads:
+            t.join()
+        self.batch.flush()
+        
+        self.assertEqual(self.counter.value, 80000)
+        # Cells of finished threads are dropped once flushed
+        self.assertEqual(self.batch._cells, [])
+    
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_fork_resets_state(self):
+        # The parent has counted (so it has a flusher) and not yet flushed
+        for _ in range(5):
+            self.batch.inc()
+        
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                for _ in range(10):
+                    self.batch.inc()
+                self.batch.flush()
+                alive = self.batch._flusher is not None and self.batch._flusher.is_alive()
+                os.write(write_fd, f'{self.counter.value} {alive}'.encode())
+                status = 0
+            finally:
+                os._exit(status)
+        
+        os.close(write_fd)
+        _, status = os.waitpid(pid, 0)
+        with os.fdopen(read_fd) as f:
+            result = f.read()
+        self.assertEqual(status, 0)
+        # The child counts only its own increments, with its own flusher
+        self.assertEqual(result, '10 True')
+        
+        self.batch.flush()
+        self.assertEqual(self.counter.value, 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,18 @@
 import unittest
-import threading
-from simple_db import InMemoryDB
+from concurrent.futures import ThreadPoolExecutor
+from simple_db import InMemoryDB, PRUNE_THRESHOLD
 
 class TestInMemoryDB(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Shared worker pool so concurrent tests measure lock contention,
+        # not thread start-up
+        cls.pool = ThreadPoolExecutor(max_workers=8)
+    
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.shutdown()
+    
     def setUp(self):
         self.db = InMemoryDB()
     
@@ -34,6 +44,21 @@ class TestInMemoryDB(unittest.TestCase):
         self.db.unset('y')
         self.assertEqual(self.db.numequalto('10'), 1)
     
+    def test_set_same_value(self):
+        # Re-setting the current value leaves counts unchanged
+        self.db.set('x', '10')
+        self.db.set('x', '10')
+        self.assertEqual(self.db.numequalto('10'), 1)
+        
+        # ...and inside a transaction is still rolled back correctly
+        self.db.begin()
+        self.db.set('x', '10')
+        self.db.set('x', '20')
+        self.db.rollback()
+        self.assertEqual(self.db.get('x'), '10')
+        self.assertEqual(self.db.numequalto('10'), 1)
+        self.assertEqual(self.db.numequalto('20'), 0)
+    
     def test_simple_transaction(self):
         # Test basic transaction
         self.db.set('x', '10')
@@ -60,6 +85,28 @@ class TestInMemoryDB(unittest.TestCase):
         self.db.rollback()
         self.assertEqual(self.db.get('x'), '10')
     
+    def test_rollback_restores_unset(self):
+        # Test rollback of unset and new keys across nested frames
+        self.db.set('x', '10')
+        
+        self.db.begin()
+        self.db.unset('x')
+        self.db.set('y', '10')
+        
+        self.db.begin()
+        self.db.set('x', '20')
+        self.db.unset('y')
+        
+        self.db.rollback()
+        self.assertEqual(self.db.get('x'), 'NULL')
+        self.assertEqual(self.db.get('y'), '10')
+        
+        self.db.rollback()
+        self.assertEqual(self.db.get('x'), '10')
+        self.assertEqual(self.db.get('y'), 'NULL')
+        self.assertEqual(self.db.numequalto('10'), 1)
+        self.assertEqual(self.db.numequalto('20'), 0)
+    
     def test_commit(self):
         # Test commit in nested transactions
         self.db.set('x', '10')
@@ -99,21 +146,63 @@ class TestInMemoryDB(unittest.TestCase):
         self.assertEqual(self.db.numequalto('10'), 2)
         self.assertEqual(self.db.numequalto('20'), 0)
     
+    def test_zero_counts_pruned(self):
+        # Overwriting one key with many distinct values leaves zero counters
+        for i in range(3 * PRUNE_THRESHOLD):
+            self.db.set('x', str(i))
+        
+        self.assertLessEqual(len(self.db.value_count), PRUNE_THRESHOLD + 1)
+        self.assertEqual(self.db.numequalto('0'), 0)
+        self.assertEqual(self.db.numequalto(str(3 * PRUNE_THRESHOLD - 1)), 1)
+    
     def test_concurrent_access(self):
-        def worker():
-            for i in range(100):
-                self.db.set(f'key{i}', str(i))
-                self.assertEqual(self.db.get(f'key{i}'), str(i))
+        def worker(n):
+            i = n % 100
+            self.db.set(f'key{i}', str(i))
+            self.assertEqual(self.db.get(f'key{i}'), str(i))
         
-        threads = [threading.Thread(target=worker) for _ in range(5)]
-        for t in threads:
-            t.start()
-        for t in threads:
-            t.join()
+        # Worker exceptions (including failed assertions) re-raise here
+        list(self.pool.map(worker, range(500)))
         
         # Verify all values are correctly set
         for i in range(100):
             self.assertEqual(self.db.get(f'key{i}'), str(i))
+            self.assertEqual(self.db.numequalto(str(i)), 1)
+    
+    def test_concurrent_value_counting(self):
+        def worker(n):
+            self.db.set(f'key{n}', str(n % 10))
+        
+        list(self.pool.map(worker, range(500)))
+        
+        # Counters stay exact even though writers use different lock stripes
+        for v in range(10):
+            self.assertEqual(self.db.numequalto(str(v)), 50)
+
+    def test_concurrent_rollback(self):
+        # Rollbacks lock only their own keys' stripes while other writers run
+        self.db.set('x', '10')
+        
+        def writer(n):
+            self.db.set(f'key{n % 50}', str(n % 5))
+        
+        def transactor(n):
+            self.db.begin()
+            self.db.set('x', str(n))
+            self.db.rollback()
+        
+        futures = [self.pool.submit(transactor if n % 2 else writer, n)
+                   for n in range(1000)]
+        for f in futures:
+            f.result()
+        
+        # Transactions are global, so a writer's SET may land in (and be
+        # undone with) whichever frame is open; counts must still match
+        self.assertEqual(self.db.get('x'), '10')
+        self.assertEqual(self.db.rollback(), 'NO TRANSACTION')
+        for v in ['10'] + [str(v) for v in range(5)]:
+            expected = sum(1 for value in self.db.db.values() if value == v)
+            self.assertEqual(self.db.numequalto(v), expected)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file